@@ -0,0 +1,150 @@
+# serialization_benchmark.py
+"""
+Micro-benchmark of per-endpoint JSON serialization cost.
+
+"before" mirrors the old handlers: a dict is rebuilt per row and the result goes
+through FastAPI's default path (jsonable_encoder + json.dumps).
+"after" uses the response layer in digidoc_app: projected rows are encoded
+directly with orjson, then compressed according to Accept-Encoding.
+
+Run from the backend/ directory:
+    python benchmarks/serialization_benchmark.py --rows 20000
+"""
+import argparse
+import json
+import sys
+import timeit
+from pathlib import Path
+
+from fastapi.encoders import jsonable_encoder
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import digidoc_app  # noqa: E402
+from digidoc_app import encode_json_body  # noqa: E402
+
+
+def make_messages(rows: int):
+    return [
+        {
+            "sender": "user" if i % 2 == 0 else "bot",
+            "text": f"Message {i}: my haemoglobin was 11.2 g/dL, is that low for a 34 year old? " * 3,
+            "timestamp": f"2025-01-01T10:{i // 60 % 60:02d}:{i % 60:02d}.000Z",
+            "media": f"report_{i}.pdf" if i % 25 == 0 else None,
+        }
+        for i in range(rows)
+    ]
+
+
+def make_media(rows: int):
+    return [
+        {"name": f"report_{i}.pdf", "chat_id": f"chat_{i % 50}", "timestamp": f"2025-01-01T10:00:{i % 60:02d}.000Z"}
+        for i in range(rows)
+    ]
+
+
+def make_chats(rows: int):
+    return [
+        {"_id": f"chat_{i}", "title": f"Blood test follow-up {i}", "last_activity": "2025-01-01T10:00:00.000Z"}
+        for i in range(rows)
+    ]
+
+
+def default_encode(payload) -> bytes:
+    # What FastAPI's JSONResponse does for a plain dict return value
+    return json.dumps(
+        jsonable_encoder(payload), ensure_ascii=False, allow_nan=False, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def before_chat_data(messages):
+    serialized, media_files = [], []
+    for msg in messages:
+        serialized.append({
+            "sender": msg.get("sender"),
+            "text": msg.get("text"),
+            "timestamp": msg.get("timestamp"),
+            "media": msg.get("media"),
+        })
+        if msg.get("media"):
+            media_files.append(msg["media"])
+    return default_encode({"messages": serialized, "media_files": list(set(media_files)), "chat_id": "chat"})
+
+
+def after_chat_data(messages, accept_encoding):
+    media_files = {msg["media"] for msg in messages if msg.get("media")}
+    return encode_json_body({"messages": messages, "media_files": list(media_files), "chat_id": "chat"}, accept_encoding)
+
+
+def before_user_media(rows):
+    media_files, seen = [], set()
+    for msg in rows:
+        key = f"{msg['chat_id']}_{msg['name']}"
+        if key not in seen:
+            media_files.append({"name": msg["name"], "chat_id": msg["chat_id"], "timestamp": msg.get("timestamp")})
+            seen.add(key)
+    return default_encode({"media_files": media_files})
+
+
+def after_user_media(rows, accept_encoding):
+    media_files, seen = [], set()
+    for msg in rows:
+        key = (msg["chat_id"], msg["name"])
+        if key not in seen:
+            media_files.append(msg)
+            seen.add(key)
+    return encode_json_body({"media_files": media_files}, accept_encoding)
+
+
+def before_list_chats(chats):
+    chat_list = []
+    for chat in chats:
+        chat_list.append({"id": chat["_id"], "title": chat["title"], "last_activity": chat["last_activity"]})
+    return default_encode({"chats": chat_list})
+
+
+def after_list_chats(chats, accept_encoding):
+    chat_list = [{"id": c["_id"], "title": c["title"], "last_activity": c["last_activity"]} for c in chats]
+    return encode_json_body({"chats": chat_list}, accept_encoding)
+
+
+def bench(fn, repeat: int) -> float:
+    return min(timeit.repeat(fn, number=1, repeat=repeat)) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    messages, media, chats = make_messages(args.rows), make_media(args.rows), make_chats(args.rows)
+    cases = [
+        ("/chat-data", lambda: before_chat_data(messages), lambda enc: after_chat_data(messages, enc)),
+        ("/user/media", lambda: before_user_media(media), lambda enc: after_user_media(media, enc)),
+        ("/chats", lambda: before_list_chats(chats), lambda enc: after_list_chats(chats, enc)),
+    ]
+
+    # Without brotli installed encode_json_body falls back to gzip, so the br column would be mislabelled
+    has_brotli = digidoc_app.brotli is not None
+
+    print(f"rows={args.rows}  (best of {args.repeat}, milliseconds; bytes on the wire)")
+    if not has_brotli:
+        print("brotli is not installed: after+br is n/a (pip install brotli to measure it)")
+    print(f"{'endpoint':<14}{'before':>10}{'after':>10}{'after+gzip':>12}{'after+br':>10}{'raw KB':>10}{'gzip KB':>10}")
+    for name, before, after in cases:
+        raw, _ = after("")
+        gz, _ = after("gzip")
+        br_ms = f"{bench(lambda: after('br'), args.repeat):>10.1f}" if has_brotli else f"{'n/a':>10}"
+        print(
+            f"{name:<14}"
+            f"{bench(before, args.repeat):>10.1f}"
+            f"{bench(lambda: after(''), args.repeat):>10.1f}"
+            f"{bench(lambda: after('gzip'), args.repeat):>12.1f}"
+            f"{br_ms}"
+            f"{len(raw) / 1024:>10.0f}"
+            f"{len(gz) / 1024:>10.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,12 @@
 # api.py
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Depends, status
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Depends, Query, Request, BackgroundTasks, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel, EmailStr
-from langchain_ollama import OllamaLLM
+from langchain_ollama import OllamaLLM, OllamaEmbeddings
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+import numpy as np
 from PIL import Image
 from contextlib import asynccontextmanager
 import asyncio
@@ -21,7 +23,14 @@ import jwt
 from passlib.context import CryptContext
 from motor.motor_asyncio import AsyncIOMotorClient
 from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
 import uuid
+import re
+import hashlib
+import zlib
+import gzip
+import time
+from collections import OrderedDict
 
 load_dotenv()
 
@@ -37,6 +46,40 @@ pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
 DATABASE_NAME = "digidoc"
 
+# Search settings
+SEARCH_SNIPPET_CHARS = 160
+SEARCH_MAX_PAGE_SIZE = 100
+# Ranking is done per request, so deep pages are capped to keep each search bounded
+SEARCH_MAX_PAGES = 10
+
+# Report retrieval settings
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "nomic-embed-text")
+RETRIEVAL_CHUNK_SIZE = 800
+RETRIEVAL_CHUNK_OVERLAP = 100
+RETRIEVAL_TOP_K = 4
+RETRIEVAL_MIN_SCORE = 0.35
+RETRIEVAL_CACHE_USERS = 256
+# Cached indexes are per worker, so they are reloaded after this long to pick up other workers' uploads
+RETRIEVAL_CACHE_TTL_SECONDS = 30
+
+# Message storage settings
+# "documents": one document per message in `messages`
+# "buckets": messages grouped per chat in `message_buckets`
+MESSAGE_STORAGE = os.getenv("MESSAGE_STORAGE", "documents")
+BUCKET_MAX_MESSAGES = int(os.getenv("BUCKET_MAX_MESSAGES", "200"))
+BUCKET_MAX_BYTES = int(os.getenv("BUCKET_MAX_BYTES", str(512 * 1024)))
+# Chats idle for this many days are compacted into compressed archives (0 disables)
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "0"))
+ARCHIVE_SWEEP_INTERVAL_SECONDS = 3600
+# A restore claim older than this is assumed to belong to a crashed worker and is taken over
+ARCHIVE_RESTORE_CLAIM_SECONDS = 300
+BUCKET_MIGRATION_CLAIM_SECONDS = 600
+
+# JSON responses smaller than this are sent uncompressed
+RESPONSE_COMPRESSION_MIN_BYTES = 1024
+# Responses with at least this many rows are encoded/compressed in a worker thread
+RESPONSE_OFFLOAD_MIN_ROWS = 500
+
 # Hardcoded Gemini credentials (edit these values in-code)
 client: genai.Client | None = None
 
@@ -56,6 +99,17 @@ try:
 except Exception:
     pytesseract = None
 
+# Optional response encoding libs
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+try:
+    import brotli
+except Exception:
+    brotli = None
+
 # MongoDB client
 mongo_client: AsyncIOMotorClient | None = None
 
@@ -78,15 +132,31 @@ async def lifespan(app: FastAPI):
         # Test the connection
         await mongo_client.admin.command('ping')
         print("MongoDB client initialized successfully.")
+        await ensure_indexes()
+        await backfill_message_owners()
+        print("MongoDB indexes ready.")
+        if MESSAGE_STORAGE == "buckets" and await mongo_client[DATABASE_NAME].messages.find_one({}, {"_id": 1}):
+            print("WARNING: MESSAGE_STORAGE=buckets but legacy messages remain; run `python migrate_to_buckets.py`.")
     except Exception as e:
         print(f"ERROR: Could not initialize MongoDB client: {e}")
 
+    archive_task = None
+    if ARCHIVE_AFTER_DAYS > 0:
+        archive_task = asyncio.create_task(archive_sweeper())
+
     # Yield control to the application to handle requests
     yield
 
     # --- 🛑 Shutdown Code (Executed when Ctrl+C is pressed) 🛑 ---
     print("\nApplication Shutdown: Closing clients...")
 
+    if archive_task:
+        archive_task.cancel()
+        try:
+            await archive_task
+        except asyncio.CancelledError:
+            pass
+
     if client:
         try:
             client.close()
@@ -119,6 +189,16 @@ security = HTTPBearer()
 # Initialize Ollama model once
 model = OllamaLLM(model="llama3.2:3b")
 
+# Local embeddings + chunker for the per-user report index
+embeddings = OllamaEmbeddings(model=EMBEDDING_MODEL)
+text_splitter = RecursiveCharacterTextSplitter(
+    chunk_size=RETRIEVAL_CHUNK_SIZE,
+    chunk_overlap=RETRIEVAL_CHUNK_OVERLAP
+)
+
+# LRU of user_id -> (loaded_at, normalized embedding matrix, chunk metadata); rebuilt from Mongo on miss/expiry
+report_index_cache: OrderedDict[str, tuple[float, np.ndarray, list[dict]]] = OrderedDict()
+
 # MEDIA directory setup
 MEDIA_DIR = Path("MEDIA")
 MEDIA_DIR.mkdir(exist_ok=True)
@@ -185,6 +265,49 @@ def get_password_hash(password):
             password = ""
     return pwd_context.hash(password)
 
+def accepted_encodings(accept_encoding: str) -> set[str]:
+    """Parse an Accept-Encoding header into the set of codings the client allows (q > 0)."""
+    codings = set()
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        q = params.strip().removeprefix("q=")
+        try:
+            if params and float(q) <= 0:
+                continue
+        except ValueError:
+            pass
+        if coding:
+            codings.add(coding.strip().lower())
+    return codings
+
+def encode_json_body(payload, accept_encoding: str = "") -> tuple[bytes, str | None]:
+    """Serialize a payload to JSON and compress it when it is large enough to be worth it."""
+    if orjson is not None:
+        body = orjson.dumps(payload)
+    else:
+        body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    if len(body) < RESPONSE_COMPRESSION_MIN_BYTES or not accept_encoding:
+        return body, None
+    codings = accepted_encodings(accept_encoding)
+    if brotli is not None and "br" in codings:
+        return brotli.compress(body, quality=4), "br"
+    if "gzip" in codings:
+        return gzip.compress(body, compresslevel=5), "gzip"
+    return body, None
+
+async def json_response(request: Request, payload, rows: int = 0) -> Response:
+    """Encode a JSON response; large ones (by row count) are encoded off the event loop."""
+    accept_encoding = request.headers.get("accept-encoding", "")
+    if rows >= RESPONSE_OFFLOAD_MIN_ROWS:
+        body, encoding = await asyncio.to_thread(encode_json_body, payload, accept_encoding)
+    else:
+        body, encoding = encode_json_body(payload, accept_encoding)
+    headers = {"Vary": "Accept-Encoding"}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
+
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -226,26 +349,590 @@ async def create_chat(user_id: str, chat_id: str, title: str = ""):
     await db.chats.insert_one(chat_doc)
     return chat_doc
 
-async def save_message(chat_id: str, sender: str, text: str, timestamp: str, media: str = None):
+async def ensure_indexes():
+    """Create the indexes the chat and search endpoints rely on (idempotent)."""
+    db = await get_db()
+    await db.chats.create_index([("user_id", 1), ("updated_at", -1)])
+    await db.messages.create_index([("chat_id", 1), ("timestamp", 1)])
+    # Text indexes are prefixed with user_id so every search only scans the caller's entries
+    await db.messages.create_index([("user_id", 1), ("text", "text")], name="messages_text_search")
+    await db.media_texts.create_index([("chat_id", 1), ("media", 1)], unique=True)
+    await db.media_texts.create_index([("user_id", 1), ("text", "text")], name="media_texts_text_search")
+    await db.report_chunks.create_index([("user_id", 1), ("embedding_model", 1)])
+    await db.report_chunks.create_index([("chat_id", 1), ("media", 1)])
+    await db.message_buckets.create_index([("chat_id", 1), ("first_timestamp", 1)])
+    # At most one bucket per chat accepts new messages
+    await db.message_buckets.create_index(
+        [("chat_id", 1)], unique=True, partialFilterExpression={"open": True}, name="message_buckets_open"
+    )
+    await db.message_buckets.create_index([("user_id", 1), ("messages.text", "text")], name="message_buckets_text_search")
+    await db.message_archives.create_index([("user_id", 1)])
+    await db.message_archives.create_index([("user_id", 1), ("text", "text")], name="message_archives_text_search")
+
+async def backfill_message_owners():
+    """Stamp user_id on messages saved before it was stored, so they become searchable.
+
+    Runs once per database: a marker in `migrations` skips the collection scan on later startups.
+    """
+    db = await get_db()
+    if await db.migrations.find_one({"_id": "message_owners_backfill", "done_at": {"$exists": True}}):
+        return
+    chat_ids = await db.messages.distinct("chat_id", {"user_id": {"$exists": False}})
+    for chat_id in chat_ids:
+        chat = await db.chats.find_one({"_id": chat_id}, {"user_id": 1})
+        # Orphans (chat doc missing) get an explicit null so they are not picked up again
+        await db.messages.update_many(
+            {"chat_id": chat_id, "user_id": {"$exists": False}},
+            {"$set": {"user_id": chat["user_id"] if chat else None}}
+        )
+    await db.migrations.update_one(
+        {"_id": "message_owners_backfill"},
+        {"$set": {"done_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+
+def message_size(message: dict) -> int:
+    """Approximate BSON size of a bucketed message (fields plus a fixed per-entry overhead)."""
+    return 64 + sum(len((message.get(k) or "").encode("utf-8")) for k in ("sender", "text", "timestamp", "media"))
+
+def pack_buckets(chat_id: str, user_id, messages: list[dict], **extra) -> list[dict]:
+    """Group ordered messages into closed bucket documents respecting the message and byte limits."""
+    buckets = []
+    current = None
+    for msg in messages:
+        entry = {k: msg.get(k) for k in ("sender", "text", "timestamp", "media")}
+        size = message_size(entry)
+        if current is None or current["count"] >= BUCKET_MAX_MESSAGES or current["size"] + size > BUCKET_MAX_BYTES:
+            current = {
+                "chat_id": chat_id,
+                "user_id": user_id,
+                "open": False,
+                **extra,
+                "count": 0,
+                "size": 0,
+                "first_timestamp": entry["timestamp"],
+                "last_timestamp": entry["timestamp"],
+                "messages": []
+            }
+            buckets.append(current)
+        current["messages"].append(entry)
+        current["count"] += 1
+        current["size"] += size
+        current["last_timestamp"] = max(current["last_timestamp"] or "", entry["timestamp"] or "")
+    return buckets
+
+async def save_message(chat_id: str, sender: str, text: str, timestamp: str, media: str = None, user_id: str = None):
     db = await get_db()
     message_doc = {
         "chat_id": chat_id,
+        "user_id": ObjectId(user_id) if user_id else None,
         "sender": sender,
         "text": text,
         "timestamp": timestamp,
         "media": media
     }
-    await db.messages.insert_one(message_doc)
-    return message_doc
+    if MESSAGE_STORAGE != "buckets":
+        await db.messages.insert_one(message_doc)
+        return message_doc
+
+    # Append to the chat's single open bucket, or close it and open a new one once it is full
+    entry = {"sender": sender, "text": text, "timestamp": timestamp, "media": media}
+    size = message_size(entry)
+    while True:
+        result = await db.message_buckets.update_one(
+            {
+                "chat_id": chat_id,
+                "open": True,
+                "count": {"$lt": BUCKET_MAX_MESSAGES},
+                "size": {"$lte": BUCKET_MAX_BYTES - size}
+            },
+            {
+                "$push": {"messages": entry},
+                "$inc": {"count": 1, "size": size},
+                "$min": {"first_timestamp": timestamp},
+                "$max": {"last_timestamp": timestamp}
+            }
+        )
+        if result.matched_count:
+            return message_doc
+
+        await db.message_buckets.update_many({"chat_id": chat_id, "open": True}, {"$set": {"open": False}})
+        try:
+            await db.message_buckets.insert_one({
+                "chat_id": chat_id,
+                "user_id": message_doc["user_id"],
+                "open": True,
+                "count": 1,
+                "size": size,
+                "first_timestamp": timestamp,
+                "last_timestamp": timestamp,
+                "messages": [entry]
+            })
+            return message_doc
+        except DuplicateKeyError:
+            # Another request opened a bucket concurrently; append to that one instead
+            continue
+
+async def insert_messages(chat_id: str, user_id, messages: list[dict], **extra):
+    """Bulk-insert already ordered messages for a chat into the active storage layout."""
+    if not messages:
+        return
+    db = await get_db()
+    if MESSAGE_STORAGE == "buckets":
+        await db.message_buckets.insert_many(pack_buckets(chat_id, user_id, messages, **extra))
+    else:
+        await db.messages.insert_many([
+            {
+                "chat_id": chat_id,
+                "user_id": user_id,
+                **extra,
+                **{k: msg.get(k) for k in ("sender", "text", "timestamp", "media")}
+            }
+            for msg in messages
+        ])
+
+async def read_live_messages(chat_id: str) -> tuple[list[dict], list]:
+    """Return a chat's ordered messages plus the _ids of the documents they were read from."""
+    db = await get_db()
+    if MESSAGE_STORAGE == "buckets":
+        buckets = await db.message_buckets.find(
+            {"chat_id": chat_id},
+            {"messages": 1}
+        ).sort([("first_timestamp", 1), ("_id", 1)]).to_list(length=None)
+        return [msg for bucket in buckets for msg in bucket["messages"]], [bucket["_id"] for bucket in buckets]
+
+    docs = await db.messages.find(
+        {"chat_id": chat_id},
+        {"sender": 1, "text": 1, "timestamp": 1, "media": 1}
+    ).sort("timestamp", 1).to_list(length=None)
+    return [{k: doc.get(k) for k in ("sender", "text", "timestamp", "media")} for doc in docs], [doc["_id"] for doc in docs]
+
+def storage_collection(db, storage: str):
+    return db.message_buckets if storage == "buckets" else db.messages
+
+async def migrate_messages_to_buckets():
+    """Move legacy one-document-per-message chats into buckets (run via migrate_to_buckets.py).
+
+    A claim in `migrations` stops two runs from interleaving. Buckets are tagged with the
+    first source message _id, so a run interrupted between insert and delete is cleaned up
+    and redone on the next run instead of duplicated.
+    """
+    db = await get_db()
+    now = datetime.now(timezone.utc)
+    try:
+        await db.migrations.insert_one({"_id": "bucket_migration", "claimed_at": now})
+    except DuplicateKeyError:
+        # Take over only a claim abandoned by a crashed run
+        claimed = await db.migrations.find_one_and_update(
+            {"_id": "bucket_migration", "claimed_at": {"$lt": now - timedelta(seconds=BUCKET_MIGRATION_CLAIM_SECONDS)}},
+            {"$set": {"claimed_at": now}}
+        )
+        if claimed is None:
+            raise RuntimeError("Another bucket migration is already running")
+
+    migrated = 0
+    for chat_id in await db.messages.distinct("chat_id"):
+        docs = await db.messages.find(
+            {"chat_id": chat_id},
+            {"sender": 1, "text": 1, "timestamp": 1, "media": 1, "user_id": 1}
+        ).sort([("timestamp", 1), ("_id", 1)]).to_list(length=None)
+        if not docs:
+            continue
+        chat = await db.chats.find_one({"_id": chat_id}, {"user_id": 1})
+        user_id = chat["user_id"] if chat else docs[0].get("user_id")
+        migration_id = docs[0]["_id"]
+        await db.message_buckets.delete_many({"chat_id": chat_id, "migration_id": migration_id})
+        await db.message_buckets.insert_many(pack_buckets(chat_id, user_id, docs, migration_id=migration_id))
+        await db.messages.delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}})
+        migrated += len(docs)
+        # Keep the claim fresh so long migrations are not mistaken for abandoned ones
+        await db.migrations.update_one(
+            {"_id": "bucket_migration"},
+            {"$set": {"claimed_at": datetime.now(timezone.utc)}}
+        )
+    await db.migrations.delete_one({"_id": "bucket_migration"})
+    return migrated
+
+async def archive_chat(chat: dict):
+    """Compact all of a chat's messages into a single compressed archive document.
+
+    Only the documents that were read are deleted. In bucket storage the open bucket is
+    closed first, so a message saved meanwhile lands in a new bucket and stays live.
+    """
+    db = await get_db()
+    chat_id = chat["_id"]
+    if MESSAGE_STORAGE == "buckets":
+        await db.message_buckets.update_many({"chat_id": chat_id, "open": True}, {"$set": {"open": False}})
+    messages, source_ids = await read_live_messages(chat_id)
+    if not messages:
+        return False
+
+    payload = zlib.compress(json.dumps(messages, separators=(",", ":")).encode("utf-8"), 6)
+    await db.message_archives.replace_one(
+        {"_id": chat_id},
+        {
+            "_id": chat_id,
+            "user_id": chat["user_id"],
+            "archive_id": uuid.uuid4().hex,
+            "storage": MESSAGE_STORAGE,
+            # Restores delete any of these still present, so an interrupted archive cannot duplicate
+            "source_ids": source_ids,
+            "count": len(messages),
+            "payload": payload,
+            # Kept uncompressed (and text-indexed) so /search still finds archived history
+            "text": "\n".join(msg.get("text") or "" for msg in messages),
+            # Kept uncompressed so the media gallery does not need to restore the chat
+            "media": [
+                {"name": msg["media"], "timestamp": msg.get("timestamp")}
+                for msg in messages if msg.get("media")
+            ],
+            "archived_at": datetime.now(timezone.utc)
+        },
+        upsert=True
+    )
+    # Flag before deleting so concurrent writers restore the archive first
+    await db.chats.update_one(
+        {"_id": chat_id},
+        {"$set": {"archived": True, "last_message_at": messages[-1].get("timestamp")}}
+    )
+    await storage_collection(db, MESSAGE_STORAGE).delete_many({"_id": {"$in": source_ids}})
+    return True
+
+async def restore_chat_if_archived(chat: dict | None):
+    """Transparently unpack an archived chat back into live storage before it is used."""
+    if not chat or not chat.get("archived"):
+        return
+    db = await get_db()
+    chat_id = chat["_id"]
+
+    # Claim the archive so concurrent requests cannot restore it twice
+    now = datetime.now(timezone.utc)
+    archive = await db.message_archives.find_one_and_update(
+        {
+            "_id": chat_id,
+            "$or": [
+                {"restoring_at": {"$exists": False}},
+                {"restoring_at": {"$lt": now - timedelta(seconds=ARCHIVE_RESTORE_CLAIM_SECONDS)}}
+            ]
+        },
+        {"$set": {"restoring_at": now}}
+    )
+    if archive is None:
+        # Someone else is restoring it; wait until they finish so we never read a partial chat
+        for _ in range(100):
+            if not await db.message_archives.find_one({"_id": chat_id}, {"_id": 1}):
+                break
+            await asyncio.sleep(0.05)
+        else:
+            raise HTTPException(status_code=503, detail="Chat is being restored, please retry")
+    else:
+        messages = json.loads(zlib.decompress(archive["payload"]).decode("utf-8"))
+        archive_id = archive.get("archive_id")
+        # Drop copies left behind by an interrupted archive or an interrupted earlier restore
+        await storage_collection(db, archive.get("storage")).delete_many(
+            {"_id": {"$in": archive.get("source_ids", [])}}
+        )
+        await storage_collection(db, MESSAGE_STORAGE).delete_many({"chat_id": chat_id, "restored_from": archive_id})
+        await insert_messages(chat_id, chat["user_id"], messages, restored_from=archive_id)
+        await db.message_archives.delete_one({"_id": chat_id})
+    await db.chats.update_one(
+        {"_id": chat["_id"]},
+        {"$set": {"archived": False, "restored_at": datetime.now(timezone.utc)}}
+    )
+    chat["archived"] = False
+
+async def archive_idle_chats():
+    db = await get_db()
+    cutoff = datetime.now(timezone.utc) - timedelta(days=ARCHIVE_AFTER_DAYS)
+    idle_chats = await db.chats.find(
+        {
+            "archived": {"$ne": True},
+            "updated_at": {"$lt": cutoff},
+            "$or": [{"restored_at": {"$exists": False}}, {"restored_at": {"$lt": cutoff}}]
+        },
+        {"_id": 1, "user_id": 1}
+    ).to_list(length=None)
+    archived = 0
+    for chat in idle_chats:
+        if await archive_chat(chat):
+            archived += 1
+    return archived
+
+async def archive_sweeper():
+    """Background loop that periodically archives idle chats."""
+    while True:
+        try:
+            archived = await archive_idle_chats()
+            if archived:
+                print(f"Archived {archived} idle chats.")
+        except Exception as e:
+            print(f"Warning: Chat archival sweep failed: {e}")
+        await asyncio.sleep(ARCHIVE_SWEEP_INTERVAL_SECONDS)
+
+async def save_media_text(user_id: str, chat_id: str, media: str, text: str):
+    """Store (or replace) the text extracted from an uploaded file so it can be searched."""
+    db = await get_db()
+    await db.media_texts.update_one(
+        {"chat_id": chat_id, "media": media},
+        {"$set": {
+            "user_id": ObjectId(user_id),
+            "text": text,
+            "updated_at": datetime.now(timezone.utc)
+        }},
+        upsert=True
+    )
+
+def extract_media_text(file_path: Path, is_image: bool) -> str:
+    """Extract plain text from a PDF (PyMuPDF) or image (Tesseract) if the libraries are installed."""
+    try:
+        if is_image:
+            if pytesseract is None or Image is None:
+                return ""
+            return pytesseract.image_to_string(Image.open(file_path)).strip()
+        if fitz is None:
+            return ""
+        with fitz.open(file_path) as doc:
+            return "\n".join(page.get_text() for page in doc).strip()
+    except Exception as e:
+        print(f"Warning: Could not extract text from {file_path}: {e}")
+        return ""
+
+def normalize_vectors(vectors) -> np.ndarray:
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+async def index_report(user_id: str, chat_id: str, media: str, text: str):
+    """Chunk and embed a document once, storing the vectors in the user's report index."""
+    db = await get_db()
+    content_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    existing = await db.report_chunks.find_one(
+        {"chat_id": chat_id, "media": media},
+        {"content_hash": 1, "embedding_model": 1}
+    )
+    if (existing and existing.get("content_hash") == content_hash
+            and existing.get("embedding_model") == EMBEDDING_MODEL):
+        return 0
+
+    chunks = [c for c in text_splitter.split_text(text) if c.strip()]
+    if not chunks:
+        return 0
+
+    # One batched embedding call for the whole document
+    vectors = normalize_vectors(await asyncio.to_thread(embeddings.embed_documents, chunks))
+    now = datetime.now(timezone.utc)
+    await db.report_chunks.delete_many({"chat_id": chat_id, "media": media})
+    await db.report_chunks.insert_many([
+        {
+            "user_id": ObjectId(user_id),
+            "chat_id": chat_id,
+            "media": media,
+            "chunk_index": i,
+            "text": chunk,
+            "content_hash": content_hash,
+            "embedding_model": EMBEDDING_MODEL,
+            "embedding_dim": int(vector.shape[0]),
+            "embedding": vector.tobytes(),
+            "created_at": now
+        }
+        for i, (chunk, vector) in enumerate(zip(chunks, vectors))
+    ])
+    report_index_cache.pop(user_id, None)
+    return len(chunks)
+
+async def index_uploaded_media(user_id: str, chat_id: str, filename: str, file_path: Path, is_image: bool, summary: str):
+    """Make an upload searchable and retrievable; runs after the summary has been sent."""
+    # Fall back to the summary when no local extractor is available
+    media_text = await asyncio.to_thread(extract_media_text, file_path, is_image) or summary
+    if not media_text:
+        return
+    try:
+        await save_media_text(user_id, chat_id, filename, media_text)
+    except Exception as e:
+        print(f"Warning: Could not store text of {filename} for search: {e}")
+    try:
+        await index_report(user_id, chat_id, filename, media_text)
+    except Exception as e:
+        print(f"Warning: Could not index {filename} for retrieval: {e}")
+
+async def load_report_index(user_id: str):
+    """Return the user's (embedding matrix, chunk metadata), loading it from Mongo on a cache miss."""
+    cached = report_index_cache.get(user_id)
+    if cached is not None and time.monotonic() - cached[0] < RETRIEVAL_CACHE_TTL_SECONDS:
+        report_index_cache.move_to_end(user_id)
+        return cached[1], cached[2]
+
+    # Only chunks embedded with the current model are comparable with the query vector
+    db = await get_db()
+    docs = await db.report_chunks.find(
+        {"user_id": ObjectId(user_id), "embedding_model": EMBEDDING_MODEL},
+        {"_id": 0, "chat_id": 1, "media": 1, "text": 1, "embedding": 1}
+    ).to_list(length=None)
+    if docs:
+        matrix = np.vstack([np.frombuffer(doc.pop("embedding"), dtype=np.float32) for doc in docs])
+    else:
+        matrix = np.empty((0, 0), dtype=np.float32)
+
+    report_index_cache[user_id] = (time.monotonic(), matrix, docs)
+    report_index_cache.move_to_end(user_id)
+    while len(report_index_cache) > RETRIEVAL_CACHE_USERS:
+        report_index_cache.popitem(last=False)
+    return matrix, docs
+
+async def search_reports(user_id: str, query: str, k: int = RETRIEVAL_TOP_K):
+    """Return the top-k report chunks most similar to the query."""
+    matrix, docs = await load_report_index(user_id)
+    if not docs:
+        return []
+
+    query_vector = normalize_vectors(await asyncio.to_thread(embeddings.embed_query, query))
+    scores = matrix @ query_vector
+    k = min(k, len(docs))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return [
+        {**docs[i], "score": float(scores[i])}
+        for i in top
+        if scores[i] >= RETRIEVAL_MIN_SCORE
+    ]
+
+def search_terms(query: str) -> list[str]:
+    return [t for t in re.findall(r"\w+", query.lower()) if len(t) > 1]
+
+def match_messages(messages: list[dict], query: str) -> list[tuple[int, dict]]:
+    """Return (term hits, message) for messages containing the query terms.
+
+    Mongo matches stemmed words, so this falls back to word prefixes ("fevers" -> "fever").
+    """
+    terms = search_terms(query)
+    stems = [t[:max(3, len(t) - 2)] for t in terms]
+    for candidates in (terms, stems):
+        matches = []
+        for msg in messages:
+            text = (msg.get("text") or "").lower()
+            count = sum(text.count(t) for t in candidates)
+            if count:
+                matches.append((count, msg))
+        if matches:
+            return matches
+    return []
+
+def make_snippet(text: str, query: str, width: int = SEARCH_SNIPPET_CHARS) -> str:
+    """Return a window of `text` centred on the first occurrence of any query term."""
+    text = " ".join((text or "").split())
+    if len(text) <= width:
+        return text
+    lower = text.lower()
+    hits = [i for i in (lower.find(t) for t in search_terms(query)) if i >= 0]
+    start = max(0, min(hits) - width // 3) if hits else 0
+    end = min(len(text), start + width)
+    start = max(0, end - width)
+    return f"{'…' if start > 0 else ''}{text[start:end]}{'…' if end < len(text) else ''}"
 
 async def get_chat_messages(chat_id: str):
+    messages, _ = await read_live_messages(chat_id)
+    return messages
+
+async def get_last_message_timestamps(chats: list[dict]) -> dict[str, str]:
+    """Return {chat_id: last message timestamp} for many chats in a single aggregation."""
+    last_timestamps = {chat["_id"]: chat["last_message_at"] for chat in chats if chat.get("archived")}
+    live_ids = [chat["_id"] for chat in chats if not chat.get("archived")]
+    if not live_ids:
+        return last_timestamps
+
     db = await get_db()
-    messages = await db.messages.find({"chat_id": chat_id}).sort("timestamp", 1).to_list(length=None)
+    if MESSAGE_STORAGE == "buckets":
+        collection, field = db.message_buckets, "$last_timestamp"
+    else:
+        collection, field = db.messages, "$timestamp"
+    rows = await collection.aggregate([
+        {"$match": {"chat_id": {"$in": live_ids}}},
+        {"$group": {"_id": "$chat_id", "last": {"$max": field}}}
+    ]).to_list(length=None)
+    last_timestamps.update((row["_id"], row["last"]) for row in rows)
+    return last_timestamps
+
+async def get_media_messages(user_id: ObjectId, chat_ids: list[str]):
+    """Return media-bearing messages as {name, chat_id, timestamp} across chats, newest first."""
+    db = await get_db()
+    if MESSAGE_STORAGE == "buckets":
+        messages = await db.message_buckets.aggregate([
+            {"$match": {"chat_id": {"$in": chat_ids}, "messages": {"$elemMatch": {"media": {"$ne": None}}}}},
+            {"$unwind": "$messages"},
+            {"$match": {"messages.media": {"$ne": None}}},
+            {"$project": {
+                "_id": 0,
+                "name": "$messages.media",
+                "chat_id": 1,
+                "timestamp": "$messages.timestamp"
+            }}
+        ]).to_list(length=None)
+    else:
+        messages = await db.messages.find(
+            {"chat_id": {"$in": chat_ids}, "media": {"$ne": None}},
+            {"_id": 0, "name": "$media", "chat_id": 1, "timestamp": 1}
+        ).to_list(length=None)
+
+    # Archived chats keep their media list outside the compressed payload
+    archives = await db.message_archives.find(
+        {"user_id": user_id, "_id": {"$in": chat_ids}},
+        {"media": 1}
+    ).to_list(length=None)
+    for archive in archives:
+        messages.extend(
+            {"name": item["name"], "chat_id": archive["_id"], "timestamp": item.get("timestamp")}
+            for item in archive.get("media", [])
+        )
+
+    messages.sort(key=lambda msg: msg.get("timestamp") or "", reverse=True)
     return messages
 
+async def search_messages(user_id: ObjectId, query: str, limit: int):
+    """Text-search the user's messages, returning per-message hits with a relevance score.
+
+    In document storage the hits carry their `_id` instead of the text, which is only
+    loaded for the page that is actually returned.
+    """
+    db = await get_db()
+    text_filter = {"user_id": user_id, "$text": {"$search": query}}
+    score = {"$meta": "textScore"}
+
+    if MESSAGE_STORAGE != "buckets":
+        return await db.messages.find(
+            text_filter,
+            {"chat_id": 1, "sender": 1, "timestamp": 1, "media": 1, "score": score}
+        ).sort([("score", score)]).limit(limit).to_list(length=limit)
+
+    # The text index ranks whole buckets; pick out the matching messages inside each one.
+    # Message scores never exceed their bucket's, so stop once `limit` hits outrank the next bucket.
+    cursor = db.message_buckets.find(
+        text_filter,
+        {"_id": 0, "chat_id": 1, "messages": 1, "score": score}
+    ).sort([("score", score)])
+
+    hits = []
+    async for bucket in cursor:
+        if sum(1 for hit in hits if hit["score"] >= bucket["score"]) >= limit:
+            break
+        matches = match_messages(bucket["messages"], query)
+        if not matches:
+            # No message actually contains the query; skip rather than return an unrelated snippet
+            continue
+        best = max(count for count, _ in matches)
+        hits.extend(
+            {**msg, "chat_id": bucket["chat_id"], "score": bucket["score"] * count / best}
+            for count, msg in matches
+        )
+    await cursor.close()
+    hits.sort(key=lambda hit: hit["score"], reverse=True)
+    return hits[:limit]
+
 async def get_user_chats(user_id: str):
     db = await get_db()
-    chats = await db.chats.find({"user_id": ObjectId(user_id)}).sort("updated_at", -1).to_list(length=None)
+    chats = await db.chats.find(
+        {"user_id": ObjectId(user_id)},
+        {"title": 1, "created_at": 1, "archived": 1, "last_message_at": 1}
+    ).sort("updated_at", -1).to_list(length=None)
     return chats
 
 async def update_chat_title(chat_id: str, title: str):
@@ -365,10 +1052,22 @@ async def stream_sse(request: QueryRequest, current_user: dict = Depends(get_cur
                 parts=[types.Part(text=p) for p in msg.get("parts", [])]
             ))
             
-    contents.append(types.Content(
-        role="user",
-        parts=[types.Part(text=request.query.strip())]
-    ))
+    # Ground the answer in the most relevant excerpts from the user's previously uploaded reports
+    query_parts = []
+    try:
+        report_chunks = await search_reports(str(current_user["_id"]), request.query.strip())
+    except Exception as e:
+        print(f"Warning: Report retrieval failed: {e}")
+        report_chunks = []
+    if report_chunks:
+        excerpts = "\n\n".join(
+            f"[{i}] From {chunk['media']}:\n{chunk['text']}"
+            for i, chunk in enumerate(report_chunks, start=1)
+        )
+        query_parts.append(types.Part(text=f"Context from the user's uploaded medical reports:\n{excerpts}"))
+
+    query_parts.append(types.Part(text=request.query.strip()))
+    contents.append(types.Content(role="user", parts=query_parts))
 
     response = client.models.generate_content(
         model="gemini-2.5-flash",
@@ -419,8 +1118,10 @@ async def save_message_endpoint(message: MessageData, current_user: dict = Depen
     chat = await db.chats.find_one({"_id": message.chat_id, "user_id": ObjectId(current_user["_id"])})
     if not chat:
         await create_chat(str(current_user["_id"]), message.chat_id)
+    await restore_chat_if_archived(chat)
 
-    await save_message(message.chat_id, message.sender, message.text, message.timestamp, message.media)
+    await save_message(message.chat_id, message.sender, message.text, message.timestamp, message.media,
+                       user_id=str(current_user["_id"]))
 
     # Update chat updated_at
     await db.chats.update_one(
@@ -435,7 +1136,7 @@ async def save_message_endpoint(message: MessageData, current_user: dict = Depen
     }
 
 @app.get("/chat-data/{chat_id}")
-async def get_chat_data(chat_id: str, current_user: dict = Depends(get_current_user)):
+async def get_chat_data(chat_id: str, request: Request, current_user: dict = Depends(get_current_user)):
     """
     Retrieve all messages for a specific chat
     """
@@ -445,32 +1146,19 @@ async def get_chat_data(chat_id: str, current_user: dict = Depends(get_current_u
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
 
+    await restore_chat_if_archived(chat)
+    # Messages come back already projected to {sender, text, timestamp, media}, so they are encoded as-is
     messages = await get_chat_messages(chat_id)
+    media_files = {msg["media"] for msg in messages if msg.get("media")}
 
-    # Serialize messages properly (convert ObjectId and datetime to strings)
-    serialized_messages = []
-    media_files = []
-    
-    for msg in messages:
-        serialized_msg = {
-            "sender": msg.get("sender"),
-            "text": msg.get("text"),
-            "timestamp": msg.get("timestamp"),
-            "media": msg.get("media")
-        }
-        serialized_messages.append(serialized_msg)
-        
-        if msg.get("media"):
-            media_files.append(msg["media"])
-
-    return {
-        "messages": serialized_messages,
-        "media_files": list(set(media_files)),  # Remove duplicates
+    return await json_response(request, {
+        "messages": messages,
+        "media_files": list(media_files),
         "chat_id": chat_id
-    }
+    }, rows=len(messages))
 
 @app.get("/user/media")
-async def get_user_media(current_user: dict = Depends(get_current_user)):
+async def get_user_media(request: Request, current_user: dict = Depends(get_current_user)):
     """
     Retrieve all media files uploaded by the user across all chats.
     """
@@ -485,37 +1173,148 @@ async def get_user_media(current_user: dict = Depends(get_current_user)):
     chat_ids = [str(chat["_id"]) for chat in user_chats]
     
     if not chat_ids:
-        return {"media_files": []}
+        return await json_response(request, {"media_files": []})
 
     # 2. Find messages in these chats that have media
-    messages = await db.messages.find(
-        {
-            "chat_id": {"$in": chat_ids},
-            "media": {"$ne": None}
-        }
-    ).sort("timestamp", -1).to_list(length=None)
+    messages = await get_media_messages(ObjectId(current_user["_id"]), chat_ids)
 
     media_files = []
     seen_files = set()
 
     for msg in messages:
-        if msg.get("media"):
-            # Create a unique key to prevent duplicates if references exists
-            # Assuming per-chat unique filenames or global unique? 
-            # In process_image we save to chat specific folder.
-            # But here we just want a list.
-            
-            # Simple deduplication based on filename + chat_id
-            unique_key = f"{msg['chat_id']}_{msg['media']}"
-            if unique_key not in seen_files:
-                media_files.append({
-                    "name": msg["media"],
-                    "chat_id": msg["chat_id"],
-                    "timestamp": msg.get("timestamp")
-                })
-                seen_files.add(unique_key)
-
-    return {"media_files": media_files}
+        # Simple deduplication based on filename + chat_id (files are stored per chat)
+        unique_key = (msg["chat_id"], msg["name"])
+        if unique_key not in seen_files:
+            media_files.append(msg)
+            seen_files.add(unique_key)
+
+    return await json_response(request, {"media_files": media_files}, rows=len(media_files))
+
+@app.get("/search")
+async def search_history(
+    q: str = Query(..., min_length=1),
+    page: int = Query(1, ge=1, le=SEARCH_MAX_PAGES),
+    page_size: int = Query(20, ge=1, le=SEARCH_MAX_PAGE_SIZE),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Full-text search over the user's messages (live and archived) and extracted document text, ranked by relevance.
+    """
+    query = q.strip()
+    if not query:
+        raise HTTPException(status_code=400, detail="Search query is required")
+
+    db = await get_db()
+    user_id = ObjectId(current_user["_id"])
+    # Fetch one extra hit per collection so we can tell whether another page exists
+    limit = page * page_size + 1
+    text_filter = {"user_id": user_id, "$text": {"$search": query}}
+    score = {"$meta": "textScore"}
+
+    # Rank on lightweight candidates (no text) and only load text for the returned page
+    messages = await search_messages(user_id, query, limit)
+
+    media_texts = await db.media_texts.find(
+        text_filter,
+        {"chat_id": 1, "media": 1, "updated_at": 1, "score": score}
+    ).sort([("score", score)]).limit(limit).to_list(length=limit)
+
+    archives = await db.message_archives.find(
+        text_filter,
+        {"_id": 1, "score": score}
+    ).sort([("score", score)]).limit(limit).to_list(length=limit)
+
+    hits = [
+        {
+            "type": "message",
+            "_id": msg.get("_id"),
+            "text": msg.get("text"),
+            "chat_id": msg["chat_id"],
+            "sender": msg.get("sender"),
+            "timestamp": msg.get("timestamp"),
+            "media": msg.get("media"),
+            "score": msg["score"]
+        }
+        for msg in messages
+    ]
+    hits.extend(
+        {
+            "type": "media",
+            "_id": doc["_id"],
+            "text": None,
+            "chat_id": doc["chat_id"],
+            "sender": None,
+            "timestamp": doc["updated_at"].isoformat() if doc.get("updated_at") else None,
+            "media": doc["media"],
+            "score": doc["score"]
+        }
+        for doc in media_texts
+    )
+    # One hit per archived chat; the matching message is picked out below for the returned page only
+    hits.extend(
+        {
+            "type": "archive",
+            "_id": doc["_id"],
+            "text": None,
+            "chat_id": doc["_id"],
+            "sender": None,
+            "timestamp": None,
+            "media": None,
+            "score": doc["score"]
+        }
+        for doc in archives
+    )
+    hits.sort(key=lambda hit: hit["score"], reverse=True)
+
+    start = (page - 1) * page_size
+    page_hits = hits[start:start + page_size]
+
+    for hit_type, collection in (("message", db.messages), ("media", db.media_texts)):
+        ids = [hit["_id"] for hit in page_hits if hit["type"] == hit_type and hit["text"] is None]
+        if ids:
+            texts = {
+                doc["_id"]: doc.get("text")
+                for doc in await collection.find({"_id": {"$in": ids}}, {"text": 1}).to_list(length=None)
+            }
+            for hit in page_hits:
+                if hit["type"] == hit_type and hit["text"] is None:
+                    hit["text"] = texts.get(hit["_id"])
+
+    archive_ids = [hit["_id"] for hit in page_hits if hit["type"] == "archive"]
+    if archive_ids:
+        archived = {
+            doc["_id"]: doc
+            for doc in await db.message_archives.find(
+                {"_id": {"$in": archive_ids}}, {"payload": 1, "text": 1}
+            ).to_list(length=None)
+        }
+        for hit in page_hits:
+            doc = archived.get(hit["_id"]) if hit["type"] == "archive" else None
+            if doc is None:
+                continue
+            matches = match_messages(json.loads(zlib.decompress(doc["payload"]).decode("utf-8")), query)
+            if matches:
+                _, best = max(matches, key=lambda match: match[0])
+                hit.update({k: best.get(k) for k in ("sender", "text", "timestamp", "media")})
+            else:
+                hit["text"] = doc.get("text")
+
+    results = []
+    for hit in page_hits:
+        if hit["type"] == "archive":
+            hit["type"] = "message"
+        text = hit.pop("text")
+        hit.pop("_id")
+        hit["snippet"] = make_snippet(text, query)
+        results.append(hit)
+
+    return {
+        "query": query,
+        "page": page,
+        "page_size": page_size,
+        "has_more": len(hits) > page * page_size,
+        "results": results
+    }
 
 @app.get('/media/{chat_id}/{filename}')
 async def serve_media(chat_id: str, filename: str, token: str):
@@ -544,6 +1343,7 @@ async def serve_media(chat_id: str, filename: str, token: str):
 
 @app.post('/process-image')
 async def process_image(
+    background_tasks: BackgroundTasks,
     chat_id: str = Form(...),
     file: UploadFile = File(...),
     prompt: str = Form(""),
@@ -615,6 +1415,11 @@ async def process_image(
 
         summary = response.text
 
+        # Text extraction, search storage and embedding run after the response is sent
+        background_tasks.add_task(
+            index_uploaded_media, str(current_user["_id"]), chat_id, filename, file_path, is_image, summary
+        )
+
         # Update chat updated_at
         await db.chats.update_one(
             {"_id": chat_id},
@@ -628,30 +1433,25 @@ async def process_image(
         raise HTTPException(status_code=500, detail=f"Failed to process media: {str(e)}")
 
 @app.get("/chats")
-async def list_chats(current_user: dict = Depends(get_current_user)):
+async def list_chats(request: Request, current_user: dict = Depends(get_current_user)):
     """
     List all chats for the current user.
     """
     chats = await get_user_chats(str(current_user["_id"]))
 
-    # Format for response
-    chat_list = []
-    for chat in chats:
-        # Get last message timestamp
-        db = await get_db()
-        last_message = await db.messages.find_one(
-            {"chat_id": chat["_id"]},
-            sort=[("timestamp", -1)]
-        )
-        last_activity = last_message["timestamp"] if last_message else chat["created_at"].isoformat()
+    last_timestamps = await get_last_message_timestamps(chats)
 
-        chat_list.append({
+    # Format for response
+    chat_list = [
+        {
             "id": chat["_id"],
             "title": chat["title"],
-            "last_activity": last_activity
-        })
+            "last_activity": last_timestamps.get(chat["_id"]) or chat["created_at"].isoformat()
+        }
+        for chat in chats
+    ]
 
-    return {"chats": chat_list}
+    return await json_response(request, {"chats": chat_list}, rows=len(chat_list))
 
 @app.post("/generate-title")
 async def generate_title(request: dict, current_user: dict = Depends(get_current_user)):
@@ -0,0 +1,28 @@
+# migrate_to_buckets.py
+"""
+One-off migration from one-document-per-message storage to per-chat buckets.
+
+Run it once before starting the API with MESSAGE_STORAGE=buckets:
+    python migrate_to_buckets.py
+It is safe to re-run after an interruption; concurrent runs refuse to start.
+"""
+import asyncio
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import digidoc_app
+
+
+async def main():
+    digidoc_app.mongo_client = AsyncIOMotorClient(digidoc_app.MONGODB_URL)
+    try:
+        await digidoc_app.ensure_indexes()
+        await digidoc_app.backfill_message_owners()
+        migrated = await digidoc_app.migrate_messages_to_buckets()
+        print(f"Migrated {migrated} messages into buckets.")
+    finally:
+        digidoc_app.mongo_client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())